@@ -1,19 +1,25 @@
+import sys
+
 def share_answers():
     # A favorite quotation
     quote = "Life is what happens when you're busy making other plans. – John Lennon"
-    print(f"Favorite quote: {quote}")
     
     # A food or flavor I don't like
     dislike = "I'm not a fan of licorice. It's just too bitter for my taste."
-    print(f"Disliked food/flavor: {dislike}")
     
     # A recommendation for something and why
     recommendation = "I recommend watching 'The Mandalorian' on Disney+. It's a fantastic series with great storytelling, set in the Star Wars universe."
-    print(f"Recommendation: {recommendation}")
     
     # A German word I have learned or think is useful for others to know
     german_word = "'Bitte' – It means 'please' or 'you're welcome' and is useful in many situations."
-    print(f"Useful German word: {german_word}")
+
+    # Print all answers at once
+    sys.stdout.write("\n".join([
+        f"Favorite quote: {quote}",
+        f"Disliked food/flavor: {dislike}",
+        f"Recommendation: {recommendation}",
+        f"Useful German word: {german_word}"
+    ]) + "\n")
 
 # Call the function to print the answers
 if __name__ == "__main__":
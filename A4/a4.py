@@ -5,17 +5,23 @@ while process of what I was doing is in the Jupyter notebook, along with the fun
 """
 
 # importing the earth engine module and folium (to later display the result)
+from functools import lru_cache
+
 import ee
 import folium
 
-# authenticate earth engine
-ee.Authenticate()
-
-# initialize the library I use
-ee.Initialize(project="ee-psd")
+# initialize the library I use, via the high-volume endpoint (better suited for the
+# many parallel tile requests folium issues when panning and zooming),
+# only authenticate earth engine if there are no valid credentials yet
+try:
+    ee.Initialize(project="ee-psd", opt_url="https://earthengine-highvolume.googleapis.com")
+except Exception:
+    ee.Authenticate()
+    ee.Initialize(project="ee-psd", opt_url="https://earthengine-highvolume.googleapis.com")
 
 #set parameters
-AOI = ee.Geometry.Point(8.642, 49.877)
+AOI_COORDS = [8.642, 49.877]
+AOI = ee.Geometry.Point(AOI_COORDS)
 START_DATE = "2024-06-03"
 END_DATE = "2024-06-04"
 CLOUD_FILTER = 60
@@ -23,11 +29,14 @@ CLD_PRB_THRESH = 50
 NIR_DRK_THRESH = 0.15
 CLD_PRJ_DIST = 1
 BUFFER = 50
+CLOSING_R = 2
+OPENING_R = 2
+DILATION_R = BUFFER/20
 
 def get_s2_sr_cld_col(aoi, start_date, end_date):
     """
-    Retrieves filtered collections of sentinel 2 images and joins the collection with 
-    a cloud propability dataset to better detect clouds
+    Retrieves filtered collections of sentinel 2 images and joins the bands needed for
+    masking with a cloud propability dataset to better detect clouds
     
     Parameters:
         aoi - ee.Geometry : Coordinates for area of interest
@@ -35,80 +44,90 @@ def get_s2_sr_cld_col(aoi, start_date, end_date):
         end_date - str : end date for colection (exclusive)
     
     Returns:
-        ee.ImageCollection: filtered collection of Sentinel-2 images joined with cloud
-        probability data
+        ee.ImageCollection: filtered collection of Sentinel-2 mask bands (SCL, B8) joined 
+        with cloud probability data
+        ee.ImageCollection: filtered collection of Sentinel-2 images with all SR bands
     """
     # Add sentinel 2 imagery
     s2_sr_col = (ee.ImageCollection("COPERNICUS/S2_SR_HARMONIZED")
         .filterBounds(aoi)
         .filterDate(start_date, end_date)
         .filter(ee.Filter.lte("CLOUDY_PIXEL_PERCENTAGE", CLOUD_FILTER)))
-    # Add cloud probability data
+    # Add cloud probability data, only for the images left after the cloud filter
+    valid_ids = s2_sr_col.aggregate_array("system:index")
     s2_cloudless_col = (ee.ImageCollection("COPERNICUS/S2_CLOUD_PROBABILITY")
         .filterBounds(aoi)
-        .filterDate(start_date, end_date))
+        .filterDate(start_date, end_date)
+        .filter(ee.Filter.inList("system:index", valid_ids)))
 
-    # Join both datasets by index
-    return ee.ImageCollection(ee.Join.saveFirst("s2cloudless").apply(**{
-        "primary": s2_sr_col,
+    # Join only the bands needed for masking with the cloud probability by index,
+    # so the reflectance bands are not loaded while building the mask
+    s2_mask_col = ee.ImageCollection(ee.Join.saveFirst("s2cloudless").apply(**{
+        "primary": s2_sr_col.select(["SCL", "B8"]),
         "secondary": s2_cloudless_col,
         "condition": ee.Filter.equals(**{
             "leftField": "system:index",
             "rightField": "system:index"
         })
     }))
-# Store created collection in variable
-s2_sr_cld_col_eval = get_s2_sr_cld_col(AOI, START_DATE, END_DATE)
 
-def add_cloud_bands(img):
+    return s2_mask_col, s2_sr_col
+
+def get_cloud_bands(img):
     """
-    Adds data as bands from image collection to the new image,
+    Computes the cloud probability band and the clouds band,
     data with a cloud probability above the threshold.
     
     Parameters:
-        img - ee.Image : input image that will be mask
+        img - ee.Image : input image, joined with the cloud probability
     
     Returns:
-        img - ee.Image : original image, with bands added
+        ee.Image : cloud probability band
+        ee.Image : clouds band
     """
 
     # Get cloud probability from the collection we created earlier
     cld_prb = ee.Image(img.get("s2cloudless")).select("probability")
 
     # Rename items in dataset to clouds, if they are above the set threshold 
-    is_cloud = cld_prb.gt(CLD_PRB_THRESH).rename("clouds")
-
-    # Add both image layers as bands
-    return img.addBands(ee.Image([cld_prb, is_cloud]))
+    is_cloud = cld_prb.expression(f"b(0) > {CLD_PRB_THRESH} ? 1 : 0").rename("clouds")
 
+    return cld_prb, is_cloud
 
-
-def add_shadow_bands(img):
+def get_shadow_bands(img, is_cloud, proj=None):
     """
-    Identifies potential cloud shadows by pixel value and adds them to mask
+    Identifies potential cloud shadows by pixel value
     
     Parameters:
-        img - ee.Image : input image, that will be mask
+        img - ee.Image : input image, with the SCL and B8 bands
+        is_cloud - ee.Image : clouds band, from which the shadows are projected
+        proj - ee.Projection : projection of the input image, taken from its first band if not given
     
     Returns:
-        img - ee.Image : mask, now with added shadow and dark px bands
+        ee.Image : dark pixels band
+        ee.Image : cloud projection band
+        ee.Image : shadows band
     """
 
+    # Get the projection once, so it can be reused for every reprojection
+    if proj is None:
+        proj = img.select(0).projection()
 
-    # Select everything that is not water (6) from scene classification values band
-    not_water = img.select("SCL").neq(6)
-
-    # Identify dark pixels on the NIR band and name them accordingly
+    # Identify dark pixels on the NIR band, that are not water (6) in the scene classification values band,
+    # and name them accordingly
     SR_BAND_SCALE = 1e4
-    dark_pixels = img.select("B8").lt(NIR_DRK_THRESH*SR_BAND_SCALE).multiply(not_water).rename("dark_pixels")
+    dark_pixels = (img.expression(f"(b('B8') < {NIR_DRK_THRESH*SR_BAND_SCALE}) && (b('SCL') != 6)")
+        .rename("dark_pixels"))
 
     # Determine the mean of the solar azimuth angle (angle between proj. of sun rays), 
     # to get direction where clouds are projected (UTM projection assumed)
     shadow_azimuth = ee.Number(90).subtract(ee.Number(img.get("MEAN_SOLAR_AZIMUTH_ANGLE")));
 
-    # Project cloud shadows, specified by input (CLD_PRJ_DIST)
-    cld_proj = (img.select("clouds").directionalDistanceTransform(shadow_azimuth, CLD_PRJ_DIST*10)
-        .reproject(**{"crs": img.select(0).projection(), "scale": 100})
+    # Project cloud shadows, specified by input (CLD_PRJ_DIST in km, converted to px at 100 m scale for performance),
+    # reprojected rather than given a default projection, since the search distance is counted in px,
+    # in the same projection as the final mask, so the 100 m grid lines up with the 20 m grid
+    cld_proj = (is_cloud.directionalDistanceTransform(shadow_azimuth, CLD_PRJ_DIST*1000/100)
+        .reproject(**{"crs": proj, "scale": 100})
         .select("distance")
         .mask()
         .rename("cloud_transform"))
@@ -116,33 +135,76 @@ def add_shadow_bands(img):
     # Classify shadows by multiplying areas where there are cloud projections identified and dark pixels
     shadows = cld_proj.multiply(dark_pixels).rename("shadows")
 
-    # Add all of the above shadow elements to the mask
-    return img.addBands(ee.Image([dark_pixels, cld_proj, shadows]))
+    return dark_pixels, cld_proj, shadows
+
+def dilate(mask, radius):
+    """
+    Grows a binary mask by the given radius, using a distance transform
+    
+    Parameters:
+        mask - ee.Image : binary input mask
+        radius - float : radius of the dilation (px)
+    
+    Returns:
+        ee.Image : dilated mask
+    """
+
+    # Pixels without a non-zero pixel in the neighborhood come back masked, so they are set 
+    # to a distance out of reach, the input mask is kept (e.g. outside the image footprint)
+    neighborhood = int(radius) + 1
+    return (mask.fastDistanceTransform(neighborhood).unmask(neighborhood**2).sqrt().lte(radius)
+        .updateMask(mask.mask()))
+
+def erode(mask, radius):
+    """
+    Shrinks a binary mask by the given radius, using a distance transform
+    
+    Parameters:
+        mask - ee.Image : binary input mask
+        radius - float : radius of the erosion (px)
+    
+    Returns:
+        ee.Image : eroded mask
+    """
+
+    # Pixels without a zero pixel in the neighborhood (e.g. inside large clouds) come back masked, 
+    # so they are set to a distance out of reach, the input mask is kept (e.g. outside the image footprint)
+    neighborhood = int(radius) + 1
+    return (mask.Not().fastDistanceTransform(neighborhood).unmask(neighborhood**2).sqrt().gt(radius)
+        .updateMask(mask.mask()))
 
 def add_cld_shdw_mask(img):
     """
     Combine both the identified clouds and shadows into one mask
     
     Parameters:
-        img - ee.Image : input image, to which the cloud- and shadow mask is added
+        img - ee.Image : input mask image (SCL, B8 and cloud probability), to which the 
+                         cloud- and shadow mask is added
     
     Returns:
-        ee.Image : input image, now with mask applied
+        ee.Image : input image, now with mask bands added
     """
 
-    # Run functions to bands
-    img_cloud = add_cloud_bands(img)
-    img_cloud_shadow = add_shadow_bands(img_cloud)
+    # Get the projection once, for the shadow projection and the final mask
+    proj = img.select(0).projection()
 
-    # Combine both band layers, if there are neither cloud nor shadow, set value to 0
-    is_cld_shdw = img_cloud_shadow.select("clouds").add(img_cloud_shadow.select("shadows")).gt(0)
+    # Run functions to get the bands, they are all added at once in the end
+    cld_prb, is_cloud = get_cloud_bands(img)
+    dark_pixels, cld_proj, shadows = get_shadow_bands(img, is_cloud, proj)
 
-    # Add buffer to reduce noise (small areas falsely classified as clouds), 20 m scale for performance and return the created mask applied to the image
-    is_cld_shdw = (is_cld_shdw.focalMin(2).focalMax(BUFFER*2/20)
-        .reproject(**{"crs": img.select([0]).projection(), "scale": 20})
+    # Combine both band layers, if there are neither cloud nor shadow, set value to 0
+    is_cld_shdw = is_cloud.add(shadows).gt(0)
+
+    # Fill small gaps (closing), remove noise (opening, small areas falsely classified as clouds) and add buffer (dilation),
+    # reprojected to 20 m in the same projection as the shadow projection, so the radii are 20 m px
+    is_cld_shdw = erode(dilate(is_cld_shdw, CLOSING_R), CLOSING_R)
+    is_cld_shdw = dilate(erode(is_cld_shdw, OPENING_R), OPENING_R)
+    is_cld_shdw = (dilate(is_cld_shdw, DILATION_R)
+        .reproject(**{"crs": proj, "scale": 20})
         .rename("cloudmask"))
 
-    return img_cloud_shadow.addBands(is_cld_shdw)
+    # Add all of the above bands to the image, the mask is applied for display only
+    return img.addBands(ee.Image([cld_prb, is_cloud, dark_pixels, cld_proj, shadows, is_cld_shdw]))
 
 
 
@@ -175,17 +237,39 @@ def add_ee_layer(self, ee_image_object, vis_params, name, show=True, opacity=1,
 
 folium.Map.add_ee_layer = add_ee_layer
 
-def display_cloud_layers(col):
+@lru_cache(maxsize=1)
+def _masked_col():
+    """
+    Creates the collections for the set parameters with the cloud- and shadow mask added,
+    only once the first layer is requested
+    
+    Returns:
+        ee.ImageCollection : Sentinel-2 mask collection, with the mask bands added
+        ee.ImageCollection : Sentinel-2 image collection, with all SR bands
+    """
+
+    s2_sr_cld_col_eval, s2_sr_col_eval = get_s2_sr_cld_col(AOI, START_DATE, END_DATE)
+    return s2_sr_cld_col_eval.map(add_cld_shdw_mask), s2_sr_col_eval
+
+def display_cloud_layers():
     """
     Display the previously created image masks in an interactive folium map
     
-    Parameters:
-        col - ee.ImageCollection : Sentinel-2 image collection to display
+    Returns:
+        folium.Map : map with the image and mask layers added
     """
-        
+
+    col, img_col = _masked_col()
+
     # create mosaic of previously detected clouds
     img = col.mosaic()
 
+    # create mosaic of the reflectance bands, unmasked so the mask can be compared against the scene
+    img_rgb = img_col.mosaic()
+
+    # Reflectance bands with the cloud- and shadow mask applied
+    img_rgb_masked = img_rgb.updateMask(img.select("cloudmask").Not())
+
     # Select layers for display and updtae values
     clouds = img.select("clouds").selfMask()
     shadows = img.select("shadows").selfMask()
@@ -194,14 +278,17 @@ def display_cloud_layers(col):
     cloudmask = img.select("cloudmask").selfMask()
     cloud_transform = img.select("cloud_transform")
 
-    # Create map object with folium
-    center = AOI.centroid(10).coordinates().reverse().getInfo()
+    # Create map object with folium, centered on the AOI (lat, lon) without requesting it from earth engine
+    center = AOI_COORDS[::-1]
     m = folium.Map(location=center, zoom_start=12)
 
     # Add layers to map
-    m.add_ee_layer(img,
+    m.add_ee_layer(img_rgb,
                    {"bands": ["B4", "B3", "B2"], "min": 0, "max": 2500, "gamma": 1.1},
                    "S2 image", True, 1, 9)
+    m.add_ee_layer(img_rgb_masked,
+                   {"bands": ["B4", "B3", "B2"], "min": 0, "max": 2500, "gamma": 1.1},
+                   "S2 image (masked)", False, 1, 9)
     m.add_ee_layer(probability,
                    {"min": 0, "max": 100},
                    "probability (cloud)", False, 1, 9)
@@ -222,9 +309,11 @@ def display_cloud_layers(col):
     # Add layer controls
     m.add_child(folium.LayerControl())
 
-# Display map
-s2_sr_cld_col_eval_disp = s2_sr_cld_col_eval.map(add_cld_shdw_mask)
+    return m
+
+if __name__ == "__main__":
+    # Save map, to open it in the browser
+    display_cloud_layers().save("cloudmask.html")
 
-#Test docstrings
-#if __name__ == "__main__":
+    #Test docstrings
     #help(get_s2_sr_cld_col)